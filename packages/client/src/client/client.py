@@ -8,6 +8,9 @@ from tou.client_connection import ClientConnection
 
 
 class CursesChatClient:
+    # Heartbeat never changes, so it is framed with its length prefix once
+    HEARTBEAT_FRAME = len(b"!heartbeat").to_bytes(4, 'little') + b"!heartbeat"
+
     def __init__(self, host: str, port: int, display_name: str):
         self.host = host
         self.port = port
@@ -18,6 +21,9 @@ class CursesChatClient:
         self.waiting_for_heartbeat_response = False
         self.last_heartbeat_sent_time = 0.0
 
+        # Set by stop so the heartbeat threads wake up from their waits immediately
+        self._stopped = threading.Event()
+
         self.messages: list[str] = []
         self.lock = threading.Lock()
 
@@ -49,6 +55,7 @@ class CursesChatClient:
 
     def stop(self):
         self.running = False
+        self._stopped.set()
         if self.connection.state == Connection.State.CONNECTED:
             self.connection.close()
         self._recv_thread.join()
@@ -60,49 +67,60 @@ class CursesChatClient:
     
         while self.running:
             if self.waiting_for_heartbeat_response:
-                if time.time() - self.last_heartbeat_sent_time > HEARTBEAT_TIMEOUT:
+                if time.monotonic() - self.last_heartbeat_sent_time > HEARTBEAT_TIMEOUT:
                     with self.lock:
                         self.messages.append("[SYSTEM] Disconnected from server")
                     self.stop()
                     break
-            time.sleep(1)
+            self._stopped.wait(1)
 
     def _receive_messages(self):
-        buffer = b''
+        buffer = bytearray()
 
         while self.running:
             try:
-                # Non-blocking read, may return less than requested
-                chunk = self.connection.recv(0, 4096)
-                if chunk:
-                    buffer += chunk
-                else:
-                    time.sleep(0.01)
+                # Blocks until data arrives, returns empty after a short timeout so a stop is noticed
+                # even while the connection stays open
+                chunk = self.connection.recv(1, 4096, 0.2)
+                if not chunk:
+                    # recv returns at once when the connection is gone, avoid spinning until stop
+                    if self.connection.state != Connection.State.CONNECTED:
+                        time.sleep(0.01)
                     continue
 
-                # Process as many full messages as possible
+                buffer += chunk
+
+                # Process as many full messages as possible, processed data is removed once afterwards
+                # and the messages are added to the display under a single lock
+                offset = 0
+                received = []
                 while True:
-                    if len(buffer) < 4:
+                    if len(buffer) - offset < 4:
                         break  # Not enough data for length prefix
 
-                    msg_length = int.from_bytes(buffer[0:4], 'little')
-                    if len(buffer) < 4 + msg_length:
+                    msg_length = int.from_bytes(buffer[offset:offset + 4], 'little')
+                    if len(buffer) - offset < 4 + msg_length:
                         break  # Wait for full message
 
                     # Extract and decode message
-                    msg_bytes = buffer[4:4 + msg_length]
+                    msg_bytes = buffer[offset + 4:offset + 4 + msg_length]
                     message = msg_bytes.decode("utf-8")
 
-                    # Remove processed data from buffer
-                    buffer = buffer[4 + msg_length:]
+                    offset += 4 + msg_length
 
                     if message.strip() == "!heartbeat":
                         self.last_heartbeat_time = time.time()
                         self.waiting_for_heartbeat_response = False
                         continue
 
+                    received.append(message)
+
+                if received:
                     with self.lock:
-                        self.messages.append(message)
+                        self.messages.extend(received)
+
+                # Remove processed data from buffer in place
+                del buffer[:offset]
 
             except Exception as e:
                 with self.lock:
@@ -113,13 +131,12 @@ class CursesChatClient:
     def _send_heartbeat(self):
         while self.running and self.connection.state == Connection.State.CONNECTED:
             try:
-                msg = b"!heartbeat"
-                self.connection.send(len(msg).to_bytes(4, 'little') + msg)
+                self.connection.send(CursesChatClient.HEARTBEAT_FRAME)
     
-                self.last_heartbeat_sent_time = time.time()
+                self.last_heartbeat_sent_time = time.monotonic()
                 self.waiting_for_heartbeat_response = True
     
-                time.sleep(10)
+                self._stopped.wait(10)
             except:
                 self.stop()
 
@@ -131,31 +148,50 @@ class CursesChatClient:
         max_y, max_x = stdscr.getmaxyx()
 
         input_win = curses.newwin(1, max_x, max_y - 1, 0)
-        input_win.nodelay(True)
+
+        # getch blocks for a short while instead of returning at once, so an idle loop sleeps
+        # rather than spinning, new messages are still picked up within the timeout
+        input_win.timeout(50)
         chat_win = curses.newwin(max_y - 1, max_x, 0, 0)
         chat_win.nodelay(True)
 
         input_buffer = ""
 
+        # Windows are only redrawn when their content changed, messages are only ever
+        # appended so their count tells whether the chat window is out of date
+        shown_messages = -1
+        input_dirty = True
+
         while self.running:
-            chat_win.clear()
+            if len(self.messages) != shown_messages:
+                # erase only blanks the window buffer, unlike clear it does not force a repaint of
+                # the whole terminal, so curses sends just the lines that differ
+                chat_win.erase()
+
+                # Display messages
+                with self.lock:
+                    # Window has no scrollback, so messages that no longer fit are dropped instead of kept forever
+                    del self.messages[:-(max_y - 2)]
+                    shown_messages = len(self.messages)
+                    for i, msg in enumerate(self.messages):
+                        chat_win.addstr(i, 0, msg[:max_x - 1])
 
-            # Display messages
-            with self.lock:
-                displayed_messages = self.messages[-(max_y - 2):]
-                for i, msg in enumerate(displayed_messages):
-                    chat_win.addstr(i, 0, msg[:max_x - 1])
+                chat_win.refresh()
 
-            chat_win.refresh()
+                # Redraw the input line as well so the cursor goes back to it
+                input_dirty = True
 
             # Handle user input
-            input_win.clear()
-            input_win.addstr(0, 0, "> " + input_buffer)
-            input_win.refresh()
+            if input_dirty:
+                input_win.erase()
+                input_win.addstr(0, 0, "> " + input_buffer)
+                input_win.refresh()
+                input_dirty = False
 
             c = input_win.getch()
             if c in (curses.KEY_BACKSPACE, 127, 8):
                 input_buffer = input_buffer[:-1]
+                input_dirty = True
             elif c in (curses.KEY_ENTER, 10, 13):
                 message = input_buffer.strip()
                 if message:
@@ -171,8 +207,10 @@ class CursesChatClient:
                         self.stop()
                         break
                 input_buffer = ""
+                input_dirty = True
             elif c >= 32 and c <= 126:
                 input_buffer += chr(c)
+                input_dirty = True
 
 
 def main():
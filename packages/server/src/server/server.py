@@ -8,6 +8,13 @@ from tou.connection import Connection
 class ChatServer:
     '''Server instance for chat application'''
 
+    # Longest time the server sleeps without host activity before checking connection timeouts again
+    POLL_INTERVAL = 1
+
+    # Message time only has minute precision, so it is formatted once per minute
+    _time_minute = -1
+    _time_text = ""
+
     class Connection:
         '''A connection to a chat client'''
 
@@ -38,8 +45,17 @@ class ChatServer:
 
         self._host = Host(self.address, self.port)
 
+        received = False
+
         while self._host.state == Host.State.LISTENING:
 
+            # Sleep until a connection arrives, receives data or disconnects instead of spinning over recv,
+            # a pass handles at most one message per connection so only sleep once a pass received nothing
+            if not received:
+                self._host.wait(ChatServer.POLL_INTERVAL)
+
+            received = False
+
             # Check for new listeners
             new_connection = self._host.listen()
             while new_connection:
@@ -57,6 +73,7 @@ class ChatServer:
                     buffer = connection.connection.recv(0, 4 - len(connection.buffer))
 
                     if buffer:
+                        received = True
                         connection.buffer += buffer
                         connection.last_seen = time.time()
 
@@ -80,6 +97,7 @@ class ChatServer:
                 if len(connection.buffer) < connection.msg_len:
                     buffer = connection.connection.recv(0, connection.msg_len - len(connection.buffer))
                     if buffer:
+                        received = True
                         connection.buffer += buffer
                         connection.last_seen = time.time()
                     elif time.time() - connection.last_seen > self.disconnect_timeout:
@@ -131,6 +149,7 @@ class ChatServer:
                     buffer = connection.connection.recv(0, 4 - len(connection.buffer))
 
                     if buffer:
+                        received = True
                         connection.buffer += buffer
                         connection.last_seen = time.time()
 
@@ -157,6 +176,7 @@ class ChatServer:
                     buffer = connection.connection.recv(0, connection.msg_len - len(connection.buffer))
 
                     if buffer:
+                        received = True
                         connection.buffer += buffer
                         connection.last_seen = time.time()
 
@@ -228,7 +248,13 @@ class ChatServer:
     def generate_message(sender: str, message: str) -> str:
         '''Generates a message string using the current time'''
 
-        return f"({datetime.now().strftime("%H:%M")}) [{sender}] : {message}"
+        now = time.time()
+        minute = int(now // 60)
+        if minute != ChatServer._time_minute:
+            ChatServer._time_text = datetime.fromtimestamp(now).strftime("%H:%M")
+            ChatServer._time_minute = minute
+
+        return f"({ChatServer._time_text}) [{sender}] : {message}"
     
 
     def broadcast(self, data: bytes):
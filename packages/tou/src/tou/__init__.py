@@ -1,7 +1,8 @@
-__all__ = ["connection", "client_connection", "host_connection", "host", "segment"]
+__all__ = ["connection", "client_connection", "host_connection", "host", "segment", "engine"]
 
 from . import segment
 from . import connection
+from . import engine
 from . import client_connection
 from . import host_connection
 from . import host
\ No newline at end of file
@@ -1,5 +1,6 @@
 import socket
-from time import time, sleep
+import selectors
+from time import monotonic, sleep
 from tou.segment import Segment, SegmentHeader
 from tou.connection import Connection
 
@@ -7,14 +8,18 @@ class ClientConnection(Connection):
     '''TCP over UDP connection class for a 1-to-1 connection from a client to a remote host.'''
 
 
-    def __init__(self, ip_addr: str, port: int, window_size: int = 4096, resend_delay: float = 0.1, timeout: float = 10):
-        '''Creates a connection object and establishes a handshake with the remote host'''
+    def __init__(self, ip_addr: str, port: int, window_size: int = 4096, resend_delay: float = 0.1, timeout: float = 10, nodelay: bool = False):
+        '''Creates a connection object and establishes a handshake with the remote host (nodelay disables coalescing of small sends)'''
 
         # Internal socket
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._socket.bind(('', 0))
         self._socket.connect((ip_addr, port))
 
+        # Datagrams are received into a reused buffer, views into it are only valid until the next receive
+        self._recv_buffer = bytearray(Segment.MAX_PACKED_SIZE)
+        self._recv_view = memoryview(self._recv_buffer)
+
         super().__init__(
             self._socket.getsockname()[0],
             self._socket.getsockname()[1],
@@ -23,20 +28,29 @@ class ClientConnection(Connection):
             window_size,
             SegmentHeader.SIZE,
             resend_delay,
-            timeout
+            timeout,
+            nodelay
         )
 
-        self.state = ClientConnection.State.HANDSHAKE
-        self._socket.settimeout(timeout)
-        self._three_way_handshake()
-        self._socket.setblocking(False)
+        # Background task waits until the socket is readable or send() writes to the wakeup socket pair
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._socket, selectors.EVENT_READ)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ)
 
+        # Handshake is done by the background task
         super()._connect()
 
+        if self.state != Connection.State.CONNECTED:
+            raise RuntimeError("Handshake with remote host failed")
 
-    def _internal_recv(self, buf_size) -> bytes:
+
+    def _internal_recv(self, buf_size) -> memoryview:
         try:
-            return self._socket.recv(buf_size)
+            size = self._socket.recv_into(self._recv_buffer, min(buf_size, len(self._recv_buffer)))
+            return self._recv_view[:size]
         except socket.error as e:
             if e.errno == socket.EWOULDBLOCK:
                 return b''
@@ -50,30 +64,80 @@ class ClientConnection(Connection):
         self._socket.send(data)
 
 
-    def _three_way_handshake(self):
-        '''Establishes a three-way-handshake with the remote host of this connection'''
+    def _internal_send_batch(self, batch):
+        send = self._socket.send
+        for data in batch:
+            send(data)
 
-        self._last_ack_time = time()
-        while (time() - self._last_ack_time <= self.timeout):
-            # 1. Send SYN
-            self._highest_sent_seq = Segment.generate_random_syn()
 
-            syn_segment = Segment(
-                self.local_addr[1],
-                self.remote_addr[1],
-                self._highest_sent_seq,
-                0,
-                SegmentHeader.SYN_FLAG,
-                self.incoming_window_size,
-                b''
-            )
+    def _notify(self):
+        try:
+            self._wakeup_send.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass # Background task already has a pending wakeup or has stopped
 
-            self._socket.send(syn_segment.pack())
 
-            # 2. Wait for SYN ACK
-            reply = self._internal_recv(SegmentHeader.SIZE)
+    def _wait(self, timeout: float):
+        for key, _ in self._selector.select(timeout):
+            if key.fileobj is self._wakeup_recv:
+                try:
+                    self._wakeup_recv.recv(4096)
+                except BlockingIOError:
+                    pass
+
+
+    def _after_disconnect(self):
+        self._selector.close()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
+
 
-            synack_segment = Segment.unpack(reply)
+    def _handshake(self) -> bool:
+        # Waiting for the SYN ACK doubles as the retransmit timer, a lost SYN is resent after resend_delay
+        self._socket.settimeout(self.resend_delay)
+        connected = self._three_way_handshake()
+        self._socket.setblocking(False)
+
+        return connected
+
+
+    def _three_way_handshake(self) -> bool:
+        '''Establishes a three-way-handshake with the remote host of this connection, returns whether it succeeded'''
+
+        # Bind retry loop lookups to locals
+        socket_send = self._socket.send
+        internal_recv = self._internal_recv
+        unpack = Segment.unpack
+
+        # Initial sequence number is kept across retransmits, so a SYN ACK that arrives after the SYN was resent still matches
+        self._highest_sent_seq = Segment.generate_random_syn()
+
+        syn_segment = Segment(
+            self.local_addr[1],
+            self.remote_addr[1],
+            self._highest_sent_seq,
+            0,
+            SegmentHeader.SYN_FLAG,
+            self.incoming_window_size,
+            b''
+        ).pack()
+
+        self._last_ack_time = monotonic()
+        while (monotonic() - self._last_ack_time <= self.timeout):
+            # 1. Send SYN
+            socket_send(syn_segment)
+
+            # 2. Wait for SYN ACK
+            try:
+                reply = internal_recv(SegmentHeader.SIZE)
+                synack_segment = unpack(reply, False)
+            except TimeoutError:
+                # retry handshake, the receive timeout already waited
+                continue
+            except (OSError, ValueError):
+                # retry handshake
+                sleep(self.resend_delay)
+                continue
 
             self._highest_received_ack = synack_segment.header.ack_num
             self._highest_accepted_seq = synack_segment.header.seq_num
@@ -93,14 +157,15 @@ class ClientConnection(Connection):
                 self.local_addr[1],
                 self.remote_addr[1],
                 self._highest_sent_seq,
-                self._highest_accepted_seq + 1,
+                (self._highest_accepted_seq + 1) & SegmentHeader.MAX_ACK_NUM,
                 SegmentHeader.ACK_FLAG,
                 self.incoming_window_size,
                 b''
             )
 
-            self._socket.send(ack_segment.pack())
-            break
+            socket_send(ack_segment.pack())
+            self._last_ack_time = monotonic()
+            return True
 
-        self._last_ack_time = time()
+        return False
 
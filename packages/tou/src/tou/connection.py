@@ -1,22 +1,33 @@
 from abc import abstractmethod, ABCMeta
-from time import time, sleep
-from threading import Thread, Lock
-from enum import Enum, auto
-from tou.segment import Segment, SegmentHeader
+from time import monotonic
+from threading import Thread, Lock, Condition, Event
+from bisect import bisect_left
+from collections import deque
+from operator import attrgetter
+from enum import IntEnum, auto
+from tou.segment import Segment, SegmentHeader, SegmentPool
 
 class Connection(metaclass=ABCMeta):
     '''TCP over UDP connection class for a 1-to-1 connection'''
 
 
-    class State(Enum):
-        HANDSHAKE = auto(),
-        CONNECTED = auto(),
-        CLOSING = auto(),
+    # Integer states so the checks in the background loops are plain int comparisons
+    class State(IntEnum):
+        HANDSHAKE = auto()
+        CONNECTED = auto()
+        CLOSING = auto()
         CLOSED = auto()
 
 
-    def __init__(self, local_ip_addr: str, local_port: int, remote_ip_addr: str, remote_port: int, incoming_window_size: int, outgoing_window_size: int, resend_delay: float, timeout: float):
-        '''Creates a connection object'''
+    # Lower bound for the adaptive retransmission timeout in seconds
+    MIN_RTO = 0.01
+
+    # Sort key for segments in the incoming window
+    _seq_num_key = attrgetter("header.seq_num")
+
+
+    def __init__(self, local_ip_addr: str, local_port: int, remote_ip_addr: str, remote_port: int, incoming_window_size: int, outgoing_window_size: int, resend_delay: float, timeout: float, nodelay: bool = False):
+        '''Creates a connection object (nodelay sends small writes right away instead of coalescing them)'''
 
         self.remote_addr = (remote_ip_addr, remote_port)
         self.local_addr = (local_ip_addr, local_port)
@@ -24,20 +35,44 @@ class Connection(metaclass=ABCMeta):
         # Timing attributes
         self.resend_delay = resend_delay
         self.timeout = timeout
-        self._last_ack_time = time()
+        self._last_ack_time = monotonic()
+        self._resend_time = 0.0
+
+        # Retransmission timeout adapts to the measured round trip time (RFC 6298), one segment is timed at a time
+        self._rto = resend_delay
+        self._srtt: float | None = None
+        self._rttvar = 0.0
+        self._rtt_seq: int | None = None
+        self._rtt_start = 0.0
+
+        # Set whenever the background task has new work, see _notify and _wait
+        self._wakeup = Event()
+
+        # Small sends are coalesced for up to one resend delay unless nodelay is set
+        self.nodelay = nodelay
+        self._nagle_deadline = 0.0
 
         # Attributes for outgoing data
-        self._unsent_data: bytes = b''
+        self._unsent_data = bytearray()
         self._unsent_data_lock = Lock()
-        self._queued_segments: list[Segment] = []
+        self._queued_segments: deque[Segment] = deque()
         self._queued_segments_size: int = 0
         self.outgoing_window_size: int = outgoing_window_size
+        self._send_buffer = bytearray(SegmentHeader.SIZE)
+        self._batch_buffer = bytearray(outgoing_window_size)
 
         # Attributes for incoming data
         self.incoming_window_size: int = incoming_window_size
         self._incoming_window: list[Segment] = []
-        self._received_data: bytes = b''
+        # Bit k is set while the segment with sequence number highest accepted + 1 + k is buffered in the incoming window
+        self._incoming_window_bitmap: int = 0
+        self._incoming_window_bytes: int = 0
+        # Received data lives between start and end of a buffer reserved upfront, it is compacted or grown only when full
+        self._received_data = bytearray(incoming_window_size * 2)
+        self._received_start: int = 0
+        self._received_end: int = 0
         self._received_data_lock = Lock()
+        self._received_data_cond = Condition(self._received_data_lock)
 
         # Current seq and ack numbers
         self._highest_sent_seq = 0
@@ -45,6 +80,9 @@ class Connection(metaclass=ABCMeta):
         self._highest_received_ack = 0
         self._need_send_ack = False
 
+        # Notified on every state change
+        self._state_cond = Condition()
+
 
     def send(self, data: bytes):
         '''Sends data through the connection'''
@@ -54,28 +92,26 @@ class Connection(metaclass=ABCMeta):
             # raise RuntimeError("Connection not in connected state!")
 
         with self._unsent_data_lock:
-            self._unsent_data = self._unsent_data + data
+            if not self._unsent_data:
+                self._nagle_deadline = monotonic() + self.resend_delay
+
+            self._unsent_data += data
 
+        self._notify()
 
-    def recv(self, min_size: int, max_size: int) -> bytes:
-        '''Receives incoming data from the connection'''
+
+    def recv(self, min_size: int, max_size: int, timeout: float | None = None) -> bytes:
+        '''Receives incoming data from the connection, waits until min_size bytes are available or timeout seconds have passed (None waits indefinitely)'''
 
         if self.state != Connection.State.CONNECTED:
-            return self._received_data[:max_size]
+            return self._take_received(max_size)
             # raise RuntimeError("Connection not in connected state!")
 
-        while len(self._received_data) < min_size:
-            sleep(self.resend_delay)
+        # Woken up by the background task when data arrives or the connection state changes
+        with self._received_data_cond:
+            self._received_data_cond.wait_for(lambda: self._received_end - self._received_start >= min_size or self.state != Connection.State.CONNECTED, timeout)
 
-        with self._received_data_lock:
-            if len(self._received_data) < max_size:
-                data = self._received_data
-                self._received_data = b''
-            else:
-                data = self._received_data[:max_size]
-                self._received_data = self._received_data[max_size:]
-
-        return data
+        return self._take_received(max_size)
 
 
     def close(self):
@@ -84,198 +120,444 @@ class Connection(metaclass=ABCMeta):
         if self.state != Connection.State.CONNECTED:
             raise RuntimeError("Connection not in connected state!")
 
-        self.state = Connection.State.CLOSING
-        self._flow_control_thread.join()
+        self._set_state(Connection.State.CLOSING)
+        self._notify()
 
-        self.state = Connection.State.CLOSED
+        # Background task sends the FIN and marks the connection closed, give up waiting after timeout
+        with self._state_cond:
+            self._state_cond.wait_for(lambda: self.state == Connection.State.CLOSED, self.timeout)
 
 
     def _connect(self):
-        '''Starts the connection'''
+        '''Starts the background task and waits until it has established the connection'''
+
+        self._set_state(Connection.State.HANDSHAKE)
+        self._run_background_task()
+
+        with self._state_cond:
+            self._state_cond.wait_for(lambda: self.state != Connection.State.HANDSHAKE)
+
+    def _run_background_task(self):
+        '''Runs the background task on its own thread, can be overriden by inheriting classes that share a thread between connections'''
 
-        self.state = Connection.State.CONNECTED
         self._flow_control_thread = Thread(target=self._background_task)
         self._flow_control_thread.start()
 
     def _background_task(self):
-        '''Task that runs in the background, responsible for sending and receiving data from the socket'''
+        '''Task that runs in the background, responsible for the handshake and for sending and receiving data from the socket'''
+
+        if not self._start():
+            return
+
+        step = self._step
+        wait = self._wait
+
+        # Wait for incoming segments, outgoing data or a timer instead of polling at a fixed rate
+        timeout = step()
+        while timeout is not None:
+            wait(timeout)
+            timeout = step()
+
+    def _start(self) -> bool:
+        '''Does the handshake and prepares the connection for sending, returns whether the connection was established'''
+
+        if not self._handshake():
+            self._set_state(Connection.State.CLOSED)
+            self._after_disconnect()
+            return False
+
+        # Outgoing window is only final after the handshake, so the pool is sized here
+        self._segment_pool = SegmentPool(-(-self.outgoing_window_size // Segment.MAX_SIZE) + 1)
+        self._set_state(Connection.State.CONNECTED)
+
+        return True
+
+    def _step(self) -> float | None:
+        '''Runs one round of receiving and sending, returns how long until the next round is due or None once the connection has finished'''
+
+        # Clock is read once per round and shared by everything the round does
+        now = monotonic()
+
+        if self._is_active(now):
+            while self._background_recv(now):
+                pass
+            self._background_send(now)
+
+            if self._is_active(now):
+                return self._next_timeout(now)
+
+        self._finish()
+        return None
+
+    def _is_active(self, now: float) -> bool:
+        '''Returns whether the background task still has to run, a closing connection runs until its data is acknowledged or the peer times out'''
 
-        while self.state == Connection.State.CONNECTED:
-            self._background_recv()
-            self._background_send()
-            sleep(self.resend_delay)
+        state = self.state
+        if state == Connection.State.CONNECTED:
+            return True
+
+        return state == Connection.State.CLOSING and bool(self._unsent_data or self._queued_segments) and now - self._last_ack_time <= self.timeout
+
+    def _finish(self):
+        '''Sends the closing segments and marks the connection closed'''
 
         # Handle closing locally
         if self.state == Connection.State.CLOSING:
-            while self._unsent_data or self._queued_segments:
-                self._background_recv()
-                self._background_send()
-                sleep(self.resend_delay)
-
-            fin_segment = Segment(
-                    self.local_addr[1],
-                    self.remote_addr[1],
-                    self._highest_sent_seq,
-                    self._highest_accepted_seq + 1,
-                    SegmentHeader.FIN_FLAG,
-                    self.incoming_window_size,
-                    b''
-                )
-            self._internal_send(fin_segment.pack())
+            self._send_control(SegmentHeader.FIN_FLAG)
 
         # Respond to FIN from peer with FIN ACK
         if self.state == Connection.State.CLOSED:
-            fin_segment = Segment(
-                    self.local_addr[1],
-                    self.remote_addr[1],
-                    self._highest_sent_seq,
-                    self._highest_accepted_seq + 1,
-                    SegmentHeader.FIN_FLAG | SegmentHeader.ACK_FLAG,
-                    self.incoming_window_size,
-                    b''
-                )
-            self._internal_send(fin_segment.pack())
+            self._send_control(SegmentHeader.FIN_FLAG | SegmentHeader.ACK_FLAG)
 
+        self._set_state(Connection.State.CLOSED)
         self._after_disconnect()
 
 
-    def _background_send(self):
+    def _background_send(self, now: float):
         '''Background procedure for sending segments'''
 
+        # Bind names used in the per-segment loops to locals, sequence numbers wrap around
+        # and the ACK number stays the same for every segment sent in this round
+        header_size = SegmentHeader.SIZE
+        max_size = Segment.MAX_SIZE
+        seq_max = SegmentHeader.MAX_SEQ_NUM
+        ack_num = (self._highest_accepted_seq + 1) & SegmentHeader.MAX_ACK_NUM
+        queued = self._queued_segments
+        unsent = self._unsent_data
+
         # Move unsent data into segment queue if space is available
+        new_segments: list[Segment] = []
         with self._unsent_data_lock:
-            if self._unsent_data:
-                if not self._queued_segments:
-                    self._last_ack_time = time()
+            if unsent:
+                if not queued:
+                    self._last_ack_time = now
+
+                acquire = self._segment_pool.acquire
+                src_port = self.local_addr[1]
+                dst_port = self.remote_addr[1]
+                incoming_window_size = self.incoming_window_size
+                hold_partial = not self.nodelay and now < self._nagle_deadline
+                seq_num = self._highest_sent_seq
 
-                while self._queued_segments_size + SegmentHeader.SIZE < self.outgoing_window_size and self._unsent_data:
+                # Payload bytes the next segment can take without its header overflowing the outgoing window
+                budget = self.outgoing_window_size - self._queued_segments_size - header_size
+
+                while budget > 0 and unsent:
                     # Get data that will be sent
-                    data_size = min(len(self._unsent_data), min(self.outgoing_window_size - self._queued_segments_size, Segment.MAX_SIZE + SegmentHeader.SIZE))
-                    data = self._unsent_data[:data_size]
-                    self._unsent_data = self._unsent_data[data_size:]
-
-                    self._highest_sent_seq += 1
-
-                    segment = Segment(
-                        self.local_addr[1],
-                        self.remote_addr[1],
-                        self._highest_sent_seq,
-                        self._highest_accepted_seq + 1,
-                        0,
-                        self.incoming_window_size,
-                        data
-                    )
-
-                    self._queued_segments.insert(-1, segment)
-                    self._queued_segments_size += SegmentHeader.SIZE + len(data)
-
-        # Send all segments in queue
-        if self._queued_segments:
+                    data_size = min(len(unsent), budget, max_size)
+
+                    # Hold back a trailing partial segment while earlier segments are still unacknowledged
+                    if hold_partial and queued and data_size == len(unsent) and data_size < max_size:
+                        break
+
+                    data = bytes(unsent[:data_size])
+                    del unsent[:data_size]
+
+                    seq_num = (seq_num + 1) & seq_max
+                    segment = acquire(src_port, dst_port, seq_num, ack_num, 0, incoming_window_size, data)
+
+                    queued.append(segment)
+                    new_segments.append(segment)
+                    budget -= data_size + header_size
+
+                self._queued_segments_size = self.outgoing_window_size - header_size - budget
+                self._highest_sent_seq = seq_num
+
+        # Send new segments right away, resend all segments in queue once the resend timer runs out
+        need_ack = self._need_send_ack
+        if queued:
             # Check if other side is actually responding to sent segments
-            if time() - self._last_ack_time > self.timeout:
-                self.state = Connection.State.CLOSING
+            if now - self._last_ack_time > self.timeout:
+                self._set_state(Connection.State.CLOSING)
                 return
 
-            for segment in self._queued_segments:
-                segment.header.ack_num = self._highest_accepted_seq + 1
+            if now >= self._resend_time:
+                segments = queued
+
+                # Never time a segment that was sent more than once (Karn's algorithm), and back off the timeout
+                # until a new sample arrives, otherwise a longer round trip time could never be measured (RFC 6298 5.5)
+                if len(queued) > len(new_segments):
+                    self._rtt_seq = None
+                    self._rto = min(self._rto * 2, self.timeout)
+
+                self._resend_time = now + self._rto
+            else:
+                segments = new_segments
+
+            if self._rtt_seq is None and new_segments:
+                self._rtt_seq = new_segments[0].header.seq_num
+                self._rtt_start = now
+
+            # Pack all segments back to back into one staging buffer and send them as a batch
+            batch_size = sum(header_size + segment.header.size for segment in segments)
+            if len(self._batch_buffer) < batch_size:
+                self._batch_buffer = bytearray(batch_size)
+
+            batch_view = memoryview(self._batch_buffer)
+            batch: list[memoryview] = []
+            append = batch.append
+            offset = 0
+
+            for segment in segments:
+                header = segment.header
+                header.ack_num = ack_num
 
                 # Piggyback ACK if needed
-                if self._need_send_ack:
-                    self._need_send_ack = False
-                    segment.header.flags = segment.header.flags | SegmentHeader.ACK_FLAG
+                if need_ack:
+                    need_ack = False
+                    header.flags |= SegmentHeader.ACK_FLAG
 
-                self._internal_send(segment.pack())
+                size = segment.pack_into(batch_view[offset:])
+                append(batch_view[offset:offset + size])
+                offset += size
 
+            if batch:
+                self._internal_send_batch(batch)
 
-    def _background_recv(self):
-        '''Background procedure for receiving segments'''
+        # Send ACK on its own if piggybacking was not possible
+        self._need_send_ack = False
+        if need_ack:
+            self._send_control(SegmentHeader.ACK_FLAG)
 
-        if self.state != Connection.State.CONNECTED:
-            return
+
+    def _background_recv(self, now: float) -> bool:
+        '''Background procedure for receiving a segment, returns False once there is nothing left to receive'''
+
+        if self.state == Connection.State.CLOSED:
+            return False
 
         # First, attempt to receive a segment and verify it before processing, closes the connection on an error
         try:
             data = self._internal_recv(self.incoming_window_size)
 
             if not data:
-                return
+                return False
 
-            segment = Segment.unpack(data)
+            src_port, dst_port, seq_num, ack_num, flags, remote_window, payload = Segment.unpack_fields(data)
         except Exception as e:
-            return # Ignore errors, move on to next segment
-
-        # Remove all queued segments that have a sequence number lower than the highest received ack
-        if segment.header.flags & SegmentHeader.ACK_FLAG:
-            if segment.header.ack_num > self._highest_received_ack:
-                self._highest_received_ack = segment.header.ack_num
-                self._last_ack_time = time()
-
-                while self._queued_segments:
-                    if self._queued_segments[0].header.seq_num < self._highest_received_ack:
-                        self._queued_segments_size -= SegmentHeader.SIZE + self._queued_segments[0].header.size
-                        self._queued_segments.pop(0)
-                    else:
-                        break
+            return True # Ignore errors, move on to next segment
+
+        # Fast path for pure ACKs, which make up most of the traffic during a bulk transfer
+        if flags == SegmentHeader.ACK_FLAG and not payload:
+            self._handle_ack(ack_num, now)
+            return True
 
-        # Handle receiving data and sending acknowledgement
-        if segment.payload:
-            if segment.header.seq_num <= self._highest_accepted_seq:
+        if flags & SegmentHeader.ACK_FLAG:
+            self._handle_ack(ack_num, now)
+
+        # Handle receiving data and sending acknowledgement, a segment is only created once it needs to be buffered
+        if payload:
+            accepted = self._highest_accepted_seq
+
+            if seq_num <= accepted:
                 # ACK for this segment has already been sent, OK to send again
                 self._need_send_ack = True
+            elif seq_num == accepted + 1:
+                # In order segment, deliver it directly together with the run of buffered segments that now follows it
+                bitmap = self._incoming_window_bitmap >> 1
+                flushed = (bitmap ^ (bitmap + 1)).bit_length() - 1
+
+                with self._received_data_cond:
+                    self._append_received(payload)
+
+                    if flushed:
+                        window = self._incoming_window
+                        header_size = SegmentHeader.SIZE
+
+                        for flushed_segment in window[:flushed]:
+                            self._append_received(flushed_segment.payload)
+                            self._incoming_window_bytes -= header_size + flushed_segment.header.size
+
+                        del window[:flushed]
+
+                    self._received_data_cond.notify_all()
+
+                self._incoming_window_bitmap = bitmap >> flushed
+                self._highest_accepted_seq = seq_num + flushed
+                self._need_send_ack = True
+                self._after_receive()
             else:
-                # Need to check if ACK for this segment can be sent
-                total_size = SegmentHeader.SIZE + segment.header.size
-                index = 0
-
-                while index < len(self._incoming_window):
-                    if self._incoming_window[index].header.seq_num == segment.header.seq_num:
-                        index = -1
-                        self._need_send_ack = True
-                        break
-                    elif self._incoming_window[index].header.seq_num > segment.header.seq_num:
-                        break
+                # Out of order segment, incoming window is kept sorted by sequence number and tracked in the bitmap for duplicate checks
+                bitmap = self._incoming_window_bitmap
+                bit = seq_num - accepted - 1
+
+                if bit >= self.incoming_window_size // (SegmentHeader.SIZE + 1):
+                    # Too far ahead to ever fit the incoming window, drop it before it can grow the bitmap
+                    pass
+                elif bitmap >> bit & 1:
+                    # Segment is already buffered, OK to send ACK again
+                    self._need_send_ack = True
+
+                else:
+                    header_size = SegmentHeader.SIZE
+                    window = self._incoming_window
+                    window_limit = self.incoming_window_size
+                    window_bytes = self._incoming_window_bytes
+                    segment_size = header_size + len(payload)
+                    index = bisect_left(window, seq_num, key=Connection._seq_num_key)
+
+                    # Need to check if ACK for this segment can be sent, only segments before it count towards the limit,
+                    # sum whichever side of the insertion point is shorter
+                    if index * 2 >= len(window):
+                        total_size = window_bytes - sum(header_size + window[i].header.size for i in range(index, len(window))) + segment_size
+                    else:
+                        total_size = sum(header_size + window[i].header.size for i in range(index)) + segment_size
+
+                    if total_size < window_limit:
+                        window.insert(index, Segment.from_fields(src_port, dst_port, seq_num, ack_num, flags, remote_window, bytes(payload)))
+                        bitmap |= 1 << bit
+                        window_bytes += segment_size
+
+                        # Enforce incoming window size limit by dropping the highest sequence numbers
+                        while window_bytes >= window_limit:
+                            dropped = window.pop()
+                            bitmap &= ~(1 << (dropped.header.seq_num - accepted - 1))
+                            window_bytes -= header_size + dropped.header.size
+
+                        self._incoming_window_bitmap = bitmap
+                        self._incoming_window_bytes = window_bytes
+
+        # Handle FIN from remote
+        if flags & SegmentHeader.FIN_FLAG:
+            self._set_state(Connection.State.CLOSED)
+
+        return True
+
+    def _take_received(self, max_size: int) -> bytes:
+        '''Removes and returns up to max_size bytes from the front of the received data'''
+
+        with self._received_data_lock:
+            start = self._received_start
+            end = min(self._received_end, start + max_size)
+
+            with memoryview(self._received_data) as view:
+                data = bytes(view[start:end])
+
+            # Rewind to the start of the buffer once everything has been read
+            if end == self._received_end:
+                self._received_start = self._received_end = 0
+            else:
+                self._received_start = end
+
+        return data
+
+    def _append_received(self, payload: bytes):
+        '''Appends payload to the received data, must be called with the received data lock held'''
+
+        buffer = self._received_data
+        start = self._received_start
+        end = self._received_end
+        new_end = end + len(payload)
+
+        if new_end > len(buffer):
+            # Move unread data to the front, grow the buffer only if that is still not enough room
+            buffer[:end - start] = buffer[start:end]
+            end -= start
+            new_end -= start
+            self._received_start = 0
+
+            if new_end > len(buffer):
+                buffer.extend(bytes(max(new_end, 2 * len(buffer)) - len(buffer)))
 
-                    total_size += SegmentHeader.SIZE + self._incoming_window[index].header.size
-                    index += 1
-
-                if index != -1 and total_size < self.incoming_window_size:
-                    self._incoming_window.insert(index, segment)
-
-                    # Enforce incoming window size limit
-                    for i in range(index + 1, len(self._incoming_window)):
-                        total_size += SegmentHeader.SIZE + self._incoming_window[i].header.size
-                        if total_size >= self.incoming_window_size:
-                            while len(self._incoming_window) > i:
-                                self._incoming_window.pop(-1)
-
-                    # Check if segment was next expected sequence number, flush consecutive segments and send ACK if so
-                    with self._received_data_lock:
-                        while self._incoming_window:
-                            if self._incoming_window[0].header.seq_num == self._highest_accepted_seq + 1:
-                                self._highest_accepted_seq += 1
-                                self._received_data += self._incoming_window[0].payload
-                                self._incoming_window.pop(0)
-                                self._need_send_ack = True
-                            else:
-                                break
-
-            # Send ACK immediately if piggybacking is not available
-            if self._need_send_ack and not (self._queued_segments or self._unsent_data):
-                self._need_send_ack = False
-                ack_segment = Segment(
-                    self.local_addr[1],
-                    self.remote_addr[1],
-                    self._highest_sent_seq,
-                    self._highest_accepted_seq + 1,
-                    SegmentHeader.ACK_FLAG,
-                    self.incoming_window_size,
-                    b''
-                )
-                self._internal_send(ack_segment.pack())
-
-            # Handle FIN from remote
-            if segment.header.flags & SegmentHeader.FIN_FLAG:
-                self.state = Connection.State.CLOSED
+        buffer[end:new_end] = payload
+        self._received_end = new_end
+
+    def _next_timeout(self, now: float) -> float:
+        '''Returns how long the background task can wait before a resend or a held back segment is due'''
+
+        deadline = self._resend_time if self._queued_segments else now + self.resend_delay
+
+        if self._unsent_data and now < self._nagle_deadline < deadline:
+            deadline = self._nagle_deadline
+
+        return max(deadline - now, 0.0)
+
+    def _set_state(self, state: 'Connection.State'):
+        '''Changes the connection state and wakes up threads waiting on it'''
+
+        with self._state_cond:
+            self.state = state
+            self._state_cond.notify_all()
+
+        # Blocked receives return once the connection is no longer connected
+        with self._received_data_cond:
+            self._received_data_cond.notify_all()
+
+    def _send_control(self, flags: int):
+        '''Sends a zero payload control segment with the current sequence and ack numbers'''
+
+        size = Segment.pack_control_into(
+            self._send_buffer,
+            self.local_addr[1],
+            self.remote_addr[1],
+            self._highest_sent_seq,
+            (self._highest_accepted_seq + 1) & SegmentHeader.MAX_ACK_NUM,
+            flags,
+            self.incoming_window_size
+        )
+        self._internal_send(memoryview(self._send_buffer)[:size])
+
+    def _handle_ack(self, ack_num: int, now: float):
+        '''Removes all queued segments that have a sequence number lower than the highest received ack'''
+
+        if ack_num > self._highest_received_ack:
+            self._highest_received_ack = ack_num
+            self._last_ack_time = now
+
+            if self._rtt_seq is not None and ack_num > self._rtt_seq:
+                self._update_rto(now - self._rtt_start)
+                self._rtt_seq = None
+
+            # Queued segments have consecutive sequence numbers, so the number acknowledged follows from the first one
+            queued = self._queued_segments
+            if queued:
+                acked = min(ack_num - queued[0].header.seq_num, len(queued))
+                if acked > 0:
+                    popleft = queued.popleft
+                    release = self._segment_pool.release
+                    acked_size = 0
+
+                    for _ in range(acked):
+                        segment = popleft()
+                        acked_size += segment.header.size
+                        release(segment)
+
+                    self._queued_segments_size -= acked * SegmentHeader.SIZE + acked_size
+
+            # Restart resend timer for the remaining segments
+            if queued:
+                self._resend_time = now + self._rto
+
+    def _update_rto(self, rtt: float):
+        '''Updates the smoothed round trip time and the retransmission timeout with a new sample (Jacobson/Karels)'''
+
+        if self._srtt is None:
+            self._srtt = rtt
+            self._rttvar = rtt / 2
+        else:
+            self._rttvar = 0.75 * self._rttvar + 0.25 * abs(self._srtt - rtt)
+            self._srtt = 0.875 * self._srtt + 0.125 * rtt
+
+        self._rto = min(max(self._srtt + 4 * self._rttvar, Connection.MIN_RTO), self.timeout)
+
+    def _notify(self):
+        '''Wakes up the background task, should be called whenever there is new work for it'''
+
+        self._wakeup.set()
+
+    def _wait(self, timeout: float):
+        '''Blocks the background task until notified or until timeout seconds have passed'''
+
+        self._wakeup.wait(timeout)
+        self._wakeup.clear()
+
+    def _handshake(self) -> bool:
+        '''Establishes the connection from the background task, returns whether it succeeded (no handshake needed by default)'''
+
+        return True
+
+    def _after_receive(self):
+        pass
 
     def _after_disconnect(self):
         pass
@@ -286,6 +568,12 @@ class Connection(metaclass=ABCMeta):
 
         raise NotImplementedError(self._internal_send)
 
+    def _internal_send_batch(self, batch: list[memoryview]):
+        '''Sends several segments at once, can be overriden by inheriting classes that can send a batch more efficiently'''
+
+        for data in batch:
+            self._internal_send(data)
+
     @abstractmethod
     def _internal_recv(self, buf_size: int) -> bytes:
         '''Internal implementation of recv that should be overriden by inheriting classes'''
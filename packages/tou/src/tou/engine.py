@@ -0,0 +1,136 @@
+import logging
+from time import monotonic
+from heapq import heappush, heappop
+from itertools import count
+from threading import Thread, Lock, Event
+from tou.connection import Connection
+
+log = logging.getLogger(__name__)
+
+class ConnectionEngine:
+    '''Drives the background tasks of many connections from a single thread instead of one thread per connection'''
+
+
+    def __init__(self):
+        '''Creates an engine and starts its thread'''
+
+        self._wakeup = Event()
+        self._closed = False
+
+        # Connections waiting for their first round and connections with new work, shared with other threads
+        self._lock = Lock()
+        self._starting: list[Connection] = []
+        self._ready: dict[Connection, None] = {}
+
+        # Timers ordered by deadline, only used by the engine thread
+        self._timers: list[tuple[float, int, Connection]] = []
+        self._timer_order = count()
+
+        # Deadline of the timer that is currently valid for each running connection, older timers are skipped
+        self._deadlines: dict[Connection, float] = {}
+
+        self._thread = Thread(target=self._background_task)
+        self._thread.start()
+
+
+    def add(self, connection: Connection):
+        '''Starts driving a connection, its handshake must not block'''
+
+        with self._lock:
+            self._starting.append(connection)
+
+        self._wakeup.set()
+
+
+    def notify(self, connection: Connection):
+        '''Schedules a round for a connection as soon as possible, called whenever the connection has new work'''
+
+        with self._lock:
+            self._ready[connection] = None
+
+        self._wakeup.set()
+
+
+    def close(self):
+        '''Stops the engine once all of its connections have finished'''
+
+        self._closed = True
+        self._wakeup.set()
+
+
+    def _background_task(self):
+        '''Runs rounds for connections that have been notified or whose timer has run out'''
+
+        # Bind names used on every round to locals
+        wakeup = self._wakeup
+        lock = self._lock
+        timers = self._timers
+        deadlines = self._deadlines
+        step = self._step
+
+        while not self._closed or deadlines or self._starting:
+            # Clear before collecting work so a notify that arrives afterwards is not missed
+            wakeup.clear()
+
+            with lock:
+                starting = self._starting
+                self._starting = []
+                ready = self._ready
+                self._ready = {}
+
+            now = monotonic()
+            while timers and timers[0][0] <= now:
+                deadline, _, connection = heappop(timers)
+                if deadlines.get(connection) == deadline:
+                    ready[connection] = None
+
+            timeout = timers[0][0] - now if timers else None
+
+            for connection in starting:
+                try:
+                    started = connection._start()
+                except Exception:
+                    log.exception("Connection %s failed to start", connection.remote_addr)
+                    self._abort(connection)
+                    continue
+
+                if started:
+                    deadlines[connection] = now
+                    ready[connection] = None
+
+            # Connections that have already finished can still be notified, for example by late incoming segments
+            for connection in ready:
+                if connection in deadlines:
+                    step(connection)
+
+            if not ready and not starting:
+                wakeup.wait(timeout)
+
+    def _step(self, connection: Connection):
+        '''Runs one round for a connection and sets its timer for the next one'''
+
+        try:
+            timeout = connection._step()
+        except Exception:
+            # Only the failing connection is dropped, the others driven by this engine keep running
+            log.exception("Connection %s failed", connection.remote_addr)
+            del self._deadlines[connection]
+            self._abort(connection)
+            return
+
+        if timeout is None:
+            del self._deadlines[connection]
+            return
+
+        deadline = monotonic() + timeout
+        self._deadlines[connection] = deadline
+        heappush(self._timers, (deadline, next(self._timer_order), connection))
+
+    def _abort(self, connection: Connection):
+        '''Closes a connection whose round raised without sending anything'''
+
+        try:
+            connection._set_state(Connection.State.CLOSED)
+            connection._after_disconnect()
+        except Exception:
+            log.exception("Connection %s failed to close", connection.remote_addr)
@@ -1,10 +1,18 @@
+import sys
+import errno
 import socket
-from time import sleep
-from enum import Enum, auto
-from threading import Thread, Lock
+import struct
+import logging
+import selectors
+from collections import deque
+from enum import IntEnum, auto
+from threading import Thread, Lock, Event
 from tou.host_connection import HostConnection
+from tou.engine import ConnectionEngine
 from tou.segment import Segment, SegmentHeader
 
+log = logging.getLogger(__name__)
+
 class Host:
     '''TCP over UDP host that accepts incoming connections'''
 
@@ -24,28 +32,83 @@ class Host:
             self.remote_seq_num = remote_seq_num
 
 
-    class State(Enum):
-        LISTENING = auto(),
+    class State(IntEnum):
+        LISTENING = auto()
         CLOSED = auto()
 
 
-    def __init__(self, ip_addr: str, port: int, window_size: int = 4096, resend_delay: float = 0.1, timeout: float = 10, max_connections: int = 999):
-        '''Creates a host on a given ip address and port (max_connections = -1 means no limit)'''
+    # Most datagrams read from the socket per wakeup of the background task
+    RECV_BATCH = 32
+
+    # Requested kernel socket buffer size, the shared socket carries the windows of every connection at once
+    SOCKET_BUFFER_SIZE = 1 << 20
+
+    # Linux UDP segmentation offload, the kernel splits one send into datagrams of a given size
+    UDP_SEGMENT = 103
+    GSO_MAX_SEGMENTS = 64
+    # Errors meaning the socket or device cannot segment, anything else is handled like a failed sendto
+    GSO_UNSUPPORTED_ERRNOS = (errno.EINVAL, errno.ENOPROTOOPT, errno.EOPNOTSUPP, errno.EIO)
+
+
+    def __init__(self, ip_addr: str, port: int, window_size: int = 4096, resend_delay: float = 0.1, timeout: float = 10, max_connections: int = 999, reuse_port: bool = False, nodelay: bool = False):
+        '''Creates a host on a given ip address and port (max_connections = -1 means no limit, reuse_port lets several processes share the port, nodelay is passed on to accepted connections)'''
 
         self.address = (ip_addr, port)
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        # Kernel hashes each client address to one of the sockets sharing the port, so a connection always lands on the same host
+        if reuse_port:
+            if not hasattr(socket, "SO_REUSEPORT"):
+                raise RuntimeError("SO_REUSEPORT is not supported on this platform")
+
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        # Kernel may cap the requested size, a smaller buffer only means more drops under bursts
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                self._socket.setsockopt(socket.SOL_SOCKET, option, Host.SOCKET_BUFFER_SIZE)
+            except OSError as e:
+                log.debug("Could not set socket buffer size: %r", e)
+
         self._socket.bind(self.address)
         self._socket.setblocking(False)
+        self._send_lock = Lock()
+
+        # Disabled after the first failed attempt on kernels without segmentation offload
+        self._gso = sys.platform == "linux"
+        self._recv_buffer = bytearray(Segment.MAX_PACKED_SIZE)
+        self._recv_view = memoryview(self._recv_buffer)
+
+        # SYN ACK replies carry no payload and are packed into this header sized buffer without creating a segment
+        self._control_buffer = bytearray(SegmentHeader.SIZE)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._socket, selectors.EVENT_READ)
+
+        # Socket pair used by close to wake up the background task blocked in select
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ)
 
         self.max_connections = max_connections
         self._queued_connections_lock = Lock()
         self._listened_connections: list[HostConnection] = []
-        self._queued_connections: list[HostConnection] = []
-        self._starting_connections: list[Host._ConnectionRequest] = []
+        self._queued_connections: deque[HostConnection] = deque()
+
+        # Listened and queued connections by remote address, so dispatching a datagram is a single lookup
+        self._connections_by_addr: dict[tuple[str, int], HostConnection] = {}
+        self._starting_connections: dict[tuple[str, int], Host._ConnectionRequest] = {}
 
         self.window_size = window_size
         self.resend_delay = resend_delay
         self.timeout = timeout
+        self.nodelay = nodelay
+
+        # Set when a connection is queued, receives data or disconnects, see wait
+        self._activity = Event()
+
+        # All host connections are driven by one shared thread
+        self._engine = ConnectionEngine()
 
         self.state = Host.State.LISTENING
         self._worker_thread = Thread(target=self._background_recv)
@@ -60,13 +123,23 @@ class Host:
 
         with self._queued_connections_lock:
             if self._queued_connections:
-                connection = self._queued_connections.pop(0)
+                connection = self._queued_connections.popleft()
                 self._listened_connections.append(connection)
                 return connection
             else:
                 return None
 
 
+    def wait(self, timeout: float | None = None) -> bool:
+        '''Blocks until a connection is ready to be listened to, has received data or has disconnected, returns whether anything happened before timeout'''
+
+        if self._activity.wait(timeout):
+            self._activity.clear()
+            return True
+
+        return False
+
+
     def close(self):
         '''Closes the host and all of its connections'''
 
@@ -74,102 +147,185 @@ class Host:
             raise RuntimeError("Host already closed")
 
         self.state = Host.State.CLOSED
+
+        try:
+            self._wakeup_send.send(b'\0')
+        except OSError:
+            pass
+
         self._worker_thread.join()
+        self._engine.close()
+        self._notify_activity()
+        self._selector.close()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
 
 
     def _background_recv(self):
         '''Background procedure to receive incoming segments'''
 
-        while self.state == Host.State.LISTENING:
-            sleep(self.resend_delay)
-
-            try:
-                data, addr = self._socket.recvfrom(SegmentHeader.SIZE + Segment.MAX_SIZE)
-                
-                if not data:
-                    continue
-
-            except Exception:
+        # Bind names used for every datagram to locals once
+        listening = Host.State.LISTENING
+        select = self._selector.select
+        recvfrom_into = self._socket.recvfrom_into
+        recv_buffer = self._recv_buffer
+        recv_view = self._recv_view
+        unpack = Segment.unpack
+        syn_flag = SegmentHeader.SYN_FLAG
+        ack_flag = SegmentHeader.ACK_FLAG
+        recv_batch = Host.RECV_BATCH
+        pack_control_into = Segment.pack_control_into
+        control_buffer = self._control_buffer
+        connections_by_addr = self._connections_by_addr
+        starting_connections = self._starting_connections
+
+        while self.state == listening:
+            # Wake up as soon as a datagram arrives or the host is closed
+            if not select():
                 continue
 
-            # If address is in listened or queued connections, dispatch
-            # If address is in requested connections, verify ack and establish connection
-            # If data is a syn segment, create request and reply with synack
-            # Ignore otherwise
+            # Drain a batch of datagrams per wakeup instead of selecting again before each one,
+            # the batch is bounded so a flood cannot keep the loop from noticing close
+            for _ in range(recv_batch):
+                try:
+                    size, addr = recvfrom_into(recv_buffer)
 
-            dispatched = False
+                    if not size:
+                        continue
 
-            with self._queued_connections_lock:
-                for connection in self._listened_connections:
-                    if connection.remote_addr == addr:
-                        connection._internal_recvfrom(data)
-                        dispatched = True
-                        break
+                    # View into the reused receive buffer, must be copied if kept beyond this iteration
+                    data = recv_view[:size]
 
-                if dispatched:
+                except BlockingIOError:
+                    # Socket is drained, wait for the next wakeup
+                    break
+                except Exception:
                     continue
 
-                for connection in self._queued_connections:
-                    if connection.remote_addr == addr:
-                        connection._internal_recvfrom(data)
-                        dispatched = True
-                        break
+                # If address is in listened or queued connections, dispatch
+                # If address is in requested connections, verify ack and establish connection
+                # If data is a syn segment, create request and reply with synack
+                # Ignore otherwise
+
+                # A single dict lookup is atomic and needs no lock, a connection that disconnects
+                # right after it is looked up ignores the datagram
+                target = connections_by_addr.get(addr)
 
-                if dispatched:
+                if target is not None:
+                    target._internal_recvfrom(bytes(data))
                     continue
 
                 try:
-                    segment = Segment.unpack(data)
+                    segment = unpack(data, False)
                 except Exception:
                     # Drop if data is not recognizable
                     continue
 
-                for request in self._starting_connections:
-                    if request.ip_addr == addr[0] and request.port == addr[1]:
-                        dispatched = True
+                # Connection requests are only used by this thread and need no lock
+                request = starting_connections.pop(addr, None)
 
-                        self._starting_connections.remove(request)
+                if request is not None:
+                    # Make sure ACK is valid before connecting
+                    if (segment.header.flags & ack_flag) and (segment.header.ack_num == request.local_seq_num + 1):
+                        new_connection = HostConnection(self, request)
 
-                        # Make sure ACK is valid before connecting
-                        if (segment.header.flags & SegmentHeader.ACK_FLAG) and (segment.header.ack_num == request.local_seq_num + 1):
-                            new_connection = HostConnection(self, request)
+                        with self._queued_connections_lock:
                             self._queued_connections.append(new_connection)
+                            connections_by_addr[addr] = new_connection
 
-                        break
+                        self._notify_activity()
+                        continue
 
-            if dispatched:
-                continue
+                    # A retransmitted SYN means the SYN ACK was lost or is still on its way, the same request answers it again
+                    if segment.header.flags != syn_flag or segment.header.seq_num != request.remote_seq_num:
+                        continue
+
+                elif segment.header.flags == syn_flag and len(connections_by_addr) + len(starting_connections) < self.max_connections:
+                    request = Host._ConnectionRequest(addr[0], addr[1], 0, 0, 0, 0)
+                    request.local_seq_num = Segment.generate_random_syn()
+                    request.remote_seq_num = segment.header.seq_num
+                    request.incoming_window = self.window_size
+                    request.outgoing_window = segment.header.window
 
-            if segment.header.flags == SegmentHeader.SYN_FLAG and len(self._listened_connections) + len(self._queued_connections) + len(self._starting_connections) < self.max_connections:
-                new_request = Host._ConnectionRequest(addr[0], addr[1], 0, 0, 0, 0)
-                new_request.local_seq_num = Segment.generate_random_syn()
-                new_request.remote_seq_num = segment.header.seq_num
-                new_request.incoming_window = self.window_size
-                new_request.outgoing_window = segment.header.window
+                else:
+                    continue
 
-                self._starting_connections.append(new_request)
+                starting_connections[addr] = request
 
                 # Reply with SYN ACK
                 try:
-                    synack_segment = Segment(
+                    pack_control_into(
+                        control_buffer,
                         self.address[1],
-                        new_request.port,
-                        new_request.local_seq_num,
-                        new_request.remote_seq_num + 1,
-                        SegmentHeader.SYN_FLAG | SegmentHeader.ACK_FLAG,
-                        new_request.incoming_window,
-                        b''
+                        request.port,
+                        request.local_seq_num,
+                        request.remote_seq_num + 1,
+                        syn_flag | ack_flag,
+                        request.incoming_window
                     )
-                except ValueError as e:
-                    print(repr(e))
+                except struct.error as e:
+                    log.debug("Dropping SYN from %s: %r", addr, e)
+                    continue
 
-                self._socket.sendto(synack_segment.pack(), addr)
+                with self._send_lock:
+                    self._socket.sendto(control_buffer, addr)
 
 
     def _internal_sendto(self, ip_addr: str, port: int, data: bytes):
         '''Sends raw UDP data to a specified ip address and port, used by host connections to send data to client'''
 
-        self._socket.sendto(data, (ip_addr, port))
+        with self._send_lock:
+            self._socket.sendto(data, (ip_addr, port))
+
+    def _internal_sendto_batch(self, ip_addr: str, port: int, batch: list[memoryview]):
+        '''Sends several raw UDP datagrams to a specified ip address and port while holding the send lock only once'''
+
+        address = (ip_addr, port)
+        sendto = self._socket.sendto
+        with self._send_lock:
+            sent = 0
+            if self._gso and len(batch) > 1:
+                sent = self._sendto_gso(batch, address)
+
+            # Datagrams left over when segmentation offload turns out to be unsupported are sent one by one
+            for data in batch[sent:]:
+                sendto(data, address)
+
+    def _sendto_gso(self, batch: list[memoryview], address: tuple[str, int]) -> int:
+        '''Sends a batch with one sendmsg per run of equally sized datagrams, the kernel splits each run back into datagrams (send lock must be held),
+        returns how many datagrams were sent before segmentation offload turned out to be unsupported'''
+
+        sendmsg = self._socket.sendmsg
+        count = len(batch)
+        start = 0
+
+        while start < count:
+            size = len(batch[start])
+            limit = min(count, start + Host.GSO_MAX_SEGMENTS)
+
+            # Only the last datagram of a run may be shorter than the others
+            end = start + 1
+            while end < limit and len(batch[end]) == size:
+                end += 1
+            if end < limit and len(batch[end]) < size:
+                end += 1
+
+            if end - start == 1:
+                self._socket.sendto(batch[start], address)
+            else:
+                try:
+                    sendmsg(batch[start:end], [(socket.IPPROTO_UDP, Host.UDP_SEGMENT, size.to_bytes(2, sys.byteorder))], 0, address)
+                except OSError as e:
+                    if e.errno not in Host.GSO_UNSUPPORTED_ERRNOS:
+                        raise
+
+                    log.debug("Disabling UDP segmentation offload: %r", e)
+                    self._gso = False
+                    return start
+
+            start = end
+
+        return count
 
     def _internal_disconnect(self, connection: HostConnection):
         '''Used by a dispatched host connection to disconnect'''
@@ -183,4 +339,14 @@ class Host:
             try:
                 self._queued_connections.remove(connection)
             except Exception:
-                pass
\ No newline at end of file
+                pass
+
+            if self._connections_by_addr.get(connection.remote_addr) is connection:
+                del self._connections_by_addr[connection.remote_addr]
+
+        self._notify_activity()
+
+    def _notify_activity(self):
+        '''Wakes up threads blocked in wait, used by host connections when they receive data or disconnect'''
+
+        self._activity.set()
\ No newline at end of file
@@ -1,3 +1,4 @@
+from collections import deque
 from tou.connection import Connection
 
 
@@ -16,14 +17,16 @@ class HostConnection(Connection):
             connection_request.incoming_window,
             connection_request.outgoing_window,
             host.resend_delay,
-            host.timeout
+            host.timeout,
+            host.nodelay
         )
 
         self._highest_accepted_seq = connection_request.remote_seq_num
         self._highest_sent_seq = connection_request.local_seq_num
         self._highest_received_ack = self._highest_sent_seq + 1
 
-        self._recv_buffer: list[bytes] = []
+        # Filled by the host thread and drained by the engine thread, both ends are O(1)
+        self._recv_buffer: deque[bytes] = deque()
         self.host = host
 
         super()._connect()
@@ -31,12 +34,24 @@ class HostConnection(Connection):
 
     def _internal_recv(self, buf_size) -> bytes:
         if self._recv_buffer:
-            data = self._recv_buffer.pop(0)
-            return data[:max(buf_size, len(data))]
+            data = self._recv_buffer.popleft()
+            return data[:min(buf_size, len(data))]
         else:
             return b''
 
 
+    def _run_background_task(self):
+        self.host._engine.add(self)
+
+
+    def _notify(self):
+        self.host._engine.notify(self)
+
+
+    def _after_receive(self):
+        self.host._notify_activity()
+
+
     def _after_disconnect(self):
         self.host._internal_disconnect(self)
 
@@ -45,7 +60,12 @@ class HostConnection(Connection):
         return self.host._internal_sendto(self.remote_addr[0], self.remote_addr[1], data)
 
 
+    def _internal_send_batch(self, batch):
+        return self.host._internal_sendto_batch(self.remote_addr[0], self.remote_addr[1], batch)
+
+
     def _internal_recvfrom(self, data: bytes):
         '''Sends data to this connection, used by the host class to distribute incoming segments'''
 
         self._recv_buffer.append(data)
+        self._notify()
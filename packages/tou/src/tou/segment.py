@@ -1,5 +1,7 @@
 import struct
 import random
+from binascii import crc_hqx
+from collections import deque
 
 class SegmentHeader:
     '''
@@ -20,7 +22,14 @@ class SegmentHeader:
     Note: Flag size is 16 bits just for alignment
     '''
 
-    SIZE = 20
+    # Many headers are alive at once in windows and pools, slots keep them small and fast to access
+    __slots__ = ("src_port", "dst_port", "seq_num", "ack_num", "flags", "checksum", "window", "size")
+
+    # Formats are compiled once instead of being parsed on every pack and unpack
+    STRUCT = struct.Struct("!HHIIHHHH")
+    CHECKSUM_STRUCT = struct.Struct("!H")
+    SIZE = STRUCT.size
+    CHECKSUM_OFFSET = 14
 
     SYN_FLAG = 1
     ACK_FLAG = 2
@@ -74,21 +83,37 @@ class SegmentHeader:
     def pack(self) -> bytes:
         '''Packs segment header into bytes'''
 
-        return struct.pack("!HHIIHHHH", self.src_port, self.dst_port, self.seq_num, self.ack_num, self.flags, self.checksum, self.window, self.size)
+        return SegmentHeader.STRUCT.pack(self.src_port, self.dst_port, self.seq_num, self.ack_num, self.flags, self.checksum, self.window, self.size)
 
     @staticmethod
     def unpack(bytes: bytes):
         '''Unpacks binary data into a segment header'''
 
-        if len(bytes) < 20:
+        if len(bytes) < SegmentHeader.SIZE:
             raise ValueError("Header too small")
 
         try:
-            src_port, dst_port, seq_num, ack_num, flags, checksum, window, size = struct.unpack("!HHIIHHHH", bytes)
+            src_port, dst_port, seq_num, ack_num, flags, checksum, window, size = SegmentHeader.STRUCT.unpack(bytes)
         except struct.error as e:
             raise ValueError(f"Invalid header format: {e}")
 
-        return SegmentHeader(src_port, dst_port, seq_num, ack_num, flags, checksum, window, size)
+        return SegmentHeader.from_fields(src_port, dst_port, seq_num, ack_num, flags, checksum, window, size)
+
+    @staticmethod
+    def from_fields(src_port: int, dst_port: int, seq_num: int, ack_num: int, flags: int, checksum: int, window: int, size: int):
+        '''Creates a segment header from fields that are already known to be in range (values are not validated)'''
+
+        header = SegmentHeader.__new__(SegmentHeader)
+        header.src_port = src_port
+        header.dst_port = dst_port
+        header.seq_num = seq_num
+        header.ack_num = ack_num
+        header.flags = flags
+        header.checksum = checksum
+        header.window = window
+        header.size = size
+
+        return header
 
 
 class Segment:
@@ -100,58 +125,163 @@ class Segment:
     - Payload (Up to 64 bytes)
     '''
 
+    __slots__ = ("header", "payload", "_packed", "_packed_key")
+
     MAX_SIZE = 64
 
-    def __init__(self, src_port: int, dst_port: int, seq_num: int, ack_num: int, flags: int, window: int, payload: bytes):
+    # Size of the largest packed segment, receive buffers need at least this much room
+    MAX_PACKED_SIZE = SegmentHeader.SIZE + MAX_SIZE
+
+    # Initial value of the CRC-16-CCITT checksum
+    CHECKSUM_INIT = 0xFFFF
+
+    def __init__(self, src_port: int, dst_port: int, seq_num: int, ack_num: int, flags: int, window: int, payload: bytes | memoryview):
         '''Creates a segment from given header parameters and payload (checksum is 0 until packed)'''
 
         self.header = SegmentHeader(src_port, dst_port, seq_num, ack_num, flags, 0, window, len(payload))
         self.payload = payload
 
+        # Packed bytes from the last pack_into, keyed on the fields that change on retransmit
+        self._packed: bytearray | None = None
+        self._packed_key: tuple[int, int] | None = None
+
+    def reset(self, src_port: int, dst_port: int, seq_num: int, ack_num: int, flags: int, window: int, payload: bytes):
+        '''Overwrites all header parameters and payload in place so the segment can be reused (values are not validated)'''
+
+        header = self.header
+        header.src_port = src_port
+        header.dst_port = dst_port
+        header.seq_num = seq_num
+        header.ack_num = ack_num
+        header.flags = flags
+        header.checksum = 0
+        header.window = window
+        header.size = len(payload)
+        self.payload = payload
+
+        # Packed buffer is kept for the next pack_into so reused segments do not allocate a new one
+        self._packed_key = None
+
     def pack(self) -> bytes:
         '''Pack a segment into bytes'''
 
-        # Reconstruct header with correct checksum
-        checksum = Segment.calculate_checksum(self.header.pack() + self.payload)
-        header = SegmentHeader(
-            self.header.src_port,
-            self.header.dst_port,
-            self.header.seq_num,
-            self.header.ack_num,
-            self.header.flags,
-            checksum,
-            self.header.window,
-            self.header.size
-        )
+        header = self.header
+        packed = bytearray(SegmentHeader.SIZE + header.size)
 
-        return header.pack() + self.payload
+        # Write header with zero checksum, then payload, then patch in checksum
+        SegmentHeader.STRUCT.pack_into(packed, 0, header.src_port, header.dst_port, header.seq_num, header.ack_num, header.flags, 0, header.window, header.size)
+        packed[SegmentHeader.SIZE:] = self.payload
+        SegmentHeader.CHECKSUM_STRUCT.pack_into(packed, SegmentHeader.CHECKSUM_OFFSET, crc_hqx(packed, Segment.CHECKSUM_INIT))
 
-    @staticmethod
-    def unpack(bytes: bytes):
-        '''unpacks binary data into a segment'''
+        return bytes(packed)
 
-        header = SegmentHeader.unpack(bytes[:SegmentHeader.SIZE])
+    def pack_into(self, buffer: bytearray) -> int:
+        '''Packs a segment into a writable buffer and returns the number of bytes written'''
 
-        if len(bytes) < SegmentHeader.SIZE + header.size:
-            raise ValueError("Payload too small")
+        header = self.header
+        size = SegmentHeader.SIZE + header.size
+        packed = self._packed
+
+        if self._packed_key is None:
+            # First pack since creation or reset, copy the payload once and keep it for retransmits
+            if packed is None:
+                packed = self._packed = bytearray(SegmentHeader.SIZE)
+
+            # Slice assignment resizes the kept buffer in place to fit the new payload
+            packed[SegmentHeader.SIZE:] = self.payload
+            self.repack_header(header.ack_num, header.flags)
+        elif self._packed_key != (header.ack_num, header.flags):
+            self.repack_header(header.ack_num, header.flags)
+
+        buffer[:size] = packed
+
+        return size
+
+    def repack_header(self, ack_num: int, flags: int):
+        '''Rewrites only the header of the cached packed bytes with a new ack number and flags'''
 
-        payload = bytes[SegmentHeader.SIZE:(SegmentHeader.SIZE + header.size)]
+        header = self.header
+        header.ack_num = ack_num
+        header.flags = flags
+        packed = self._packed
 
-        original_header = SegmentHeader(
+        # Write header with zero checksum over the cached payload, then patch in checksum
+        SegmentHeader.STRUCT.pack_into(
+            packed,
+            0,
             header.src_port,
             header.dst_port,
             header.seq_num,
-            header.ack_num,
-            header.flags,
+            ack_num,
+            flags,
             0,
             header.window,
             header.size
         )
+        SegmentHeader.CHECKSUM_STRUCT.pack_into(packed, SegmentHeader.CHECKSUM_OFFSET, crc_hqx(packed, Segment.CHECKSUM_INIT))
+        self._packed_key = (ack_num, flags)
+
+    @staticmethod
+    def pack_control_into(buffer: bytearray, src_port: int, dst_port: int, seq_num: int, ack_num: int, flags: int, window: int) -> int:
+        '''Packs a zero payload control segment into a writable buffer without creating a segment, returns the number of bytes written'''
+
+        SegmentHeader.STRUCT.pack_into(buffer, 0, src_port, dst_port, seq_num, ack_num, flags, 0, window, 0)
+        SegmentHeader.CHECKSUM_STRUCT.pack_into(buffer, SegmentHeader.CHECKSUM_OFFSET, crc_hqx(memoryview(buffer)[:SegmentHeader.SIZE], Segment.CHECKSUM_INIT))
+
+        return SegmentHeader.SIZE
+
+    @staticmethod
+    def unpack(data: bytes | memoryview, copy: bool = True):
+        '''unpacks binary data into a segment (copy = False keeps the payload as a slice of data)'''
+
+        src_port, dst_port, seq_num, ack_num, flags, window, payload = Segment.unpack_fields(data)
+
+        # Payload may be a view into a reused receive buffer, the segment keeps its own copy
+        # unless the caller only reads the header before the buffer is reused
+        if copy:
+            payload = bytes(payload)
+
+        return Segment.from_fields(src_port, dst_port, seq_num, ack_num, flags, window, payload)
+
+    @staticmethod
+    def from_fields(src_port: int, dst_port: int, seq_num: int, ack_num: int, flags: int, window: int, payload: bytes | memoryview):
+        '''Creates a segment from header fields that are already known to be in range, such as fields unpacked from a datagram (values are not validated)'''
+
+        segment = Segment.__new__(Segment)
+        segment.header = SegmentHeader.from_fields(src_port, dst_port, seq_num, ack_num, flags, 0, window, len(payload))
+        segment.payload = payload
+        segment._packed = None
+        segment._packed_key = None
+
+        return segment
+
+    @staticmethod
+    def unpack_fields(data: bytes | memoryview) -> tuple[int, int, int, int, int, int, bytes | memoryview]:
+        '''Verifies binary data and unpacks it into header fields and payload without creating a segment (payload is a slice of data)'''
+
+        if len(data) < SegmentHeader.SIZE:
+            raise ValueError("Header too small")
+
+        # Parse header fields straight from the datagram, without building intermediate headers
+        src_port, dst_port, seq_num, ack_num, flags, checksum, window, size = SegmentHeader.STRUCT.unpack_from(data)
 
-        if Segment.calculate_checksum(original_header.pack() + payload) != header.checksum:
+        end = SegmentHeader.SIZE + size
+        if len(data) < end:
+            raise ValueError("Payload too small")
+
+        payload = data[SegmentHeader.SIZE:end]
+
+        # Checksum was calculated with the checksum field zeroed, the CRC is continued across the
+        # bytes around the field instead of copying the datagram to zero it
+        view = memoryview(data)
+        crc = crc_hqx(view[:SegmentHeader.CHECKSUM_OFFSET], Segment.CHECKSUM_INIT)
+        crc = crc_hqx(b'\0\0', crc)
+        crc = crc_hqx(view[SegmentHeader.CHECKSUM_OFFSET + 2:end], crc)
+
+        if crc != checksum:
             raise ValueError("Checksum invalid")
 
-        return Segment(header.src_port, header.dst_port, header.seq_num, header.ack_num, header.flags, header.window, payload)
+        return src_port, dst_port, seq_num, ack_num, flags, window, payload
 
     @staticmethod
     def calculate_checksum(data: bytes) -> int:
@@ -159,26 +289,40 @@ class Segment:
         Polynomial: x^16 + x^12 + x^5 + 1 (0x1021)
         Initial value: 0xFFFF
         """
-        polynom = 0x1021  # CRC-16-CCITT polynomial
-        crc = 0xFFFF      # Initial value
-
-        for byte in data:
-            # XOR the byte with the high byte of current CRC
-            crc ^= (byte << 8)
-            # Process each bit
-            for _ in range(8):
-                # If MSB is 1, shift and XOR with polynomial
-                if crc & 0x8000:
-                    crc = ((crc << 1) ^ polynom) & 0xFFFF
-                # If MSB is 0, just shift
-                else:
-                    crc = (crc << 1) & 0xFFFF
-
-        return crc
+        # binascii implements this exact CRC in C and accepts any buffer without copying,
+        # the pack and unpack paths call it directly to skip this extra call per segment
+        return crc_hqx(data, Segment.CHECKSUM_INIT)
 
     @staticmethod
     def generate_random_syn() -> int:
         '''generates a random valid sequence number'''
 
-        # Limit to only half because wrap aroud sequence number is not supported
-        return random.randint(0, SegmentHeader.MAX_SEQ_NUM // 2)
\ No newline at end of file
+        # Limit to only half because wrap aroud sequence number is not supported, the range is a
+        # power of two so a single getrandbits call replaces the rejection sampling of randint
+        return random.getrandbits((SegmentHeader.MAX_SEQ_NUM // 2).bit_length())
+
+
+class SegmentPool:
+    '''Pool of reusable segments, avoids allocating a new segment for every segment sent'''
+
+    def __init__(self, capacity: int):
+        '''Creates a pool pre-filled with capacity empty segments'''
+
+        self.capacity = capacity
+        self._segments: deque[Segment] = deque(Segment(0, 0, 0, 0, 0, 0, b'') for _ in range(capacity))
+
+    def acquire(self, src_port: int, dst_port: int, seq_num: int, ack_num: int, flags: int, window: int, payload: bytes) -> Segment:
+        '''Takes a segment from the pool and fills it in, creates a new one if the pool is empty'''
+
+        if self._segments:
+            segment = self._segments.pop()
+            segment.reset(src_port, dst_port, seq_num, ack_num, flags, window, payload)
+            return segment
+
+        return Segment(src_port, dst_port, seq_num, ack_num, flags, window, payload)
+
+    def release(self, segment: Segment):
+        '''Returns a segment that is no longer used to the pool'''
+
+        if len(self._segments) < self.capacity:
+            self._segments.append(segment)
@@ -0,0 +1,93 @@
+import time
+import unittest
+
+from tou.connection import Connection
+from tou.segment import Segment, SegmentHeader
+
+
+class FakeConnection(Connection):
+    '''Connection fed from an in-memory inbox instead of a socket'''
+
+    def __init__(self, incoming_window_size: int = 4096):
+        super().__init__("127.0.0.1", 1, "127.0.0.1", 2, incoming_window_size, 4096, 0.01, 5)
+        self.inbox: list[bytes] = []
+        self.sent: list[bytes] = []
+        self._start()
+
+    def _internal_recv(self, max_size: int) -> bytes:
+        return self.inbox.pop(0) if self.inbox else b""
+
+    def _internal_send(self, data) -> None:
+        self.sent.append(bytes(data))
+
+    def receive(self, seq_num: int, payload: bytes) -> None:
+        self.inbox.append(Segment(2, 1, seq_num, 0, 0, 4096, payload).pack())
+        self._background_recv(time.monotonic())
+
+
+class TestIncomingWindow(unittest.TestCase):
+    def test_far_ahead_segment_does_not_grow_bitmap(self):
+        connection = FakeConnection()
+        accepted = connection._highest_accepted_seq
+
+        connection.receive(accepted + 2**31, b"x")
+
+        self.assertEqual(connection._incoming_window_bitmap, 0)
+        self.assertEqual(connection._incoming_window, [])
+
+    def test_bitmap_stays_within_window(self):
+        connection = FakeConnection()
+        accepted = connection._highest_accepted_seq
+
+        for offset in range(2, 10000, 7):
+            connection.receive(accepted + offset, b"x")
+
+        self.assertLessEqual(connection._incoming_window_bitmap.bit_length(), connection.incoming_window_size // (SegmentHeader.SIZE + 1))
+
+    def test_out_of_order_segments_are_delivered(self):
+        connection = FakeConnection()
+        accepted = connection._highest_accepted_seq
+
+        for i in (2, 0, 1):
+            connection.receive(accepted + 1 + i, bytes([i]) * 10)
+
+        self.assertEqual(bytes(connection._received_data[connection._received_start:connection._received_end]), b"\0" * 10 + b"\1" * 10 + b"\2" * 10)
+        self.assertEqual(connection._incoming_window_bitmap, 0)
+
+
+class TestRetransmissionTimeout(unittest.TestCase):
+    def exchange(self, connection: FakeConnection, now: float, rtt: float) -> float:
+        '''Sends one segment and runs send rounds every millisecond until its ACK arrives after rtt, returns the time of the ACK'''
+
+        connection.send(b"x")
+        connection._background_send(now)
+        ack_time = now + rtt
+        ack_num = connection._queued_segments[-1].header.seq_num + 1
+
+        while now + 0.001 < ack_time:
+            now += 0.001
+            connection._background_send(now)
+
+        connection._handle_ack(ack_num, ack_time)
+        return ack_time
+
+    def test_timeout_backs_off_after_round_trip_time_grows(self):
+        connection = FakeConnection()
+        connection.nodelay = True
+        now = time.monotonic()
+
+        for _ in range(30):
+            now = self.exchange(connection, now, 0.0003)
+
+        self.assertEqual(connection._rto, Connection.MIN_RTO)
+
+        connection.sent.clear()
+        for _ in range(20):
+            now = self.exchange(connection, now, 0.16)
+
+        self.assertGreater(connection._rto, 0.16)
+        self.assertLess(len(connection.sent), 40)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+
+from tou.connection import Connection
+from tou.engine import ConnectionEngine
+
+
+class ScriptedConnection(Connection):
+    '''Connection whose rounds are scripted instead of talking to a socket'''
+
+    def __init__(self, rounds: int, fail_on_start: bool = False, fail_on_step: bool = False):
+        super().__init__("127.0.0.1", 1, "127.0.0.1", 2, 4096, 4096, 0.01, 5)
+        self.rounds = rounds
+        self.fail_on_start = fail_on_start
+        self.fail_on_step = fail_on_step
+        self.disconnected = False
+
+    def _start(self) -> bool:
+        if self.fail_on_start:
+            raise RuntimeError("start failed")
+        self._set_state(Connection.State.CONNECTED)
+        return True
+
+    def _step(self) -> float | None:
+        if self.fail_on_step:
+            raise RuntimeError("step failed")
+        self.rounds -= 1
+        return 0.0 if self.rounds > 0 else None
+
+    def _after_disconnect(self):
+        self.disconnected = True
+
+    def _internal_recv(self, max_size: int) -> bytes:
+        return b""
+
+    def _internal_send(self, data) -> None:
+        pass
+
+
+class TestConnectionEngine(unittest.TestCase):
+    def test_failing_connection_does_not_stop_engine(self):
+        engine = ConnectionEngine()
+        failing_start = ScriptedConnection(1, fail_on_start=True)
+        failing_step = ScriptedConnection(1, fail_on_step=True)
+        healthy = ScriptedConnection(5)
+
+        with self.assertLogs("tou.engine", "ERROR"):
+            for connection in (failing_start, failing_step, healthy):
+                engine.add(connection)
+
+            engine.close()
+            engine._thread.join(5)
+
+        self.assertFalse(engine._thread.is_alive())
+        self.assertEqual(healthy.rounds, 0)
+        for connection in (failing_start, failing_step):
+            self.assertEqual(connection.state, Connection.State.CLOSED)
+            self.assertTrue(connection.disconnected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import errno
+import socket
+import threading
+import time
+import unittest
+
+from tou.client_connection import ClientConnection
+from tou.host import Host
+
+
+class FakeSocket:
+    '''Records sent datagrams, sendmsg fails with a given errno once it has been called a number of times'''
+
+    def __init__(self, fail_errno: int, fail_after: int):
+        self.fail_errno = fail_errno
+        self.fail_after = fail_after
+        self.datagrams: list[bytes] = []
+
+    def sendmsg(self, buffers, ancdata, flags, address):
+        if self.fail_after == 0:
+            raise OSError(self.fail_errno, "sendmsg failed")
+        self.fail_after -= 1
+        self.datagrams.extend(bytes(buffer) for buffer in buffers)
+
+    def sendto(self, data, address):
+        self.datagrams.append(bytes(data))
+
+
+class TestSegmentationOffload(unittest.TestCase):
+    def setUp(self):
+        self.host = Host("127.0.0.1", 0)
+        self.real_socket = self.host._socket
+        self.batch = [memoryview(bytes([i]) * (10 + i // 3 * 10)) for i in range(9)]
+
+    def tearDown(self):
+        self.host._socket = self.real_socket
+        self.host.close()
+
+    def send(self, fail_errno: int, fail_after: int) -> FakeSocket:
+        fake = FakeSocket(fail_errno, fail_after)
+        self.host._socket = fake
+        self.host._gso = True
+        self.host._internal_sendto_batch("127.0.0.1", 1, self.batch)
+        return fake
+
+    def test_unsupported_falls_back_without_resending(self):
+        fake = self.send(errno.EOPNOTSUPP, 1)
+
+        self.assertEqual(fake.datagrams, [bytes(data) for data in self.batch])
+        self.assertFalse(self.host._gso)
+
+    def test_transient_error_keeps_offload(self):
+        with self.assertRaises(OSError):
+            self.send(errno.ENOBUFS, 1)
+
+        self.assertTrue(self.host._gso)
+
+
+class DelayProxy:
+    '''Forwards datagrams between one client and a host, delaying each one by a fixed amount'''
+
+    def __init__(self, host_address: tuple[str, int], delay: float):
+        self.host_address = host_address
+        self.delay = delay
+        self.client_address = None
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.settimeout(0.05)
+        self.address = self.socket.getsockname()
+        self.closed = False
+        self.thread = threading.Thread(target=self._forward)
+        self.thread.start()
+
+    def close(self):
+        self.closed = True
+        self.thread.join()
+        self.socket.close()
+
+    def _forward(self):
+        while not self.closed:
+            try:
+                data, addr = self.socket.recvfrom(65536)
+            except TimeoutError:
+                continue
+
+            if addr == self.host_address:
+                destination = self.client_address
+            else:
+                self.client_address = addr
+                destination = self.host_address
+
+            threading.Timer(self.delay, self._send, (data, destination)).start()
+
+    def _send(self, data: bytes, destination: tuple[str, int]):
+        if not self.closed:
+            self.socket.sendto(data, destination)
+
+
+class TestHandshake(unittest.TestCase):
+    def test_round_trip_longer_than_resend_delay(self):
+        host = Host("127.0.0.1", 0, timeout=1)
+        proxy = DelayProxy(host._socket.getsockname(), 0.1)
+
+        try:
+            start = time.monotonic()
+            client = ClientConnection(*proxy.address, resend_delay=0.05, timeout=2)
+            self.assertEqual(client.state, ClientConnection.State.CONNECTED)
+            self.assertLess(time.monotonic() - start, 1)
+
+            deadline = time.monotonic() + 3
+            connection = host.listen()
+            while connection is None and time.monotonic() < deadline:
+                host.wait(0.1)
+                connection = host.listen()
+
+            self.assertIsNotNone(connection)
+            client.close()
+
+            # FIN also goes through the proxy, so the host side only closes once it arrives
+            while connection.state != ClientConnection.State.CLOSED and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            proxy.close()
+            host.close()
+
+
+if __name__ == "__main__":
+    unittest.main()